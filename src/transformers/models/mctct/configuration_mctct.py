@@ -57,7 +57,8 @@ class MCTCTConfig(PretrainedConfig):
             The epsilon used by the layer normalization layers.
         layerdrop (`float`, *optional*, defaults to 0.3):
             The probability of dropping an encoder layer during training. The default 0.3 value is used in the original
-            implementation.
+            implementation. LayerDrop is never applied in evaluation mode; setting it to 0.0 also keeps the sequence of
+            executed layers fixed during training, which graph capture (e.g. CUDA graphs) requires.
         hidden_act (`str` or `function`, *optional*, defaults to `"relu"`):
             The non-linear activation function (function or string) in the encoder and pooler. If string, `"gelu"`,
             `"relu"`, `"selu"` and `"gelu_new"` are supported.
@@ -15,13 +15,8 @@
 """ PyTorch M-CTC-T model."""
 
 
-import math
-import random
-from typing import Optional
-
 import torch
 import torch.utils.checkpoint
-from packaging import version
 from torch import nn
 
 from ...activations import ACT2FN
@@ -34,6 +29,7 @@ from ...modeling_utils import (
     find_pruneable_heads_and_indices,
     prune_linear_layer,
 )
+from ...pytorch_utils import is_torch_less_than_1_11, is_torch_less_than_2_0
 from ...utils import logging
 from .configuration_mctct import MCTCTConfig
 
@@ -60,19 +56,15 @@ MCTCT_PRETRAINED_MODEL_ARCHIVE_LIST = [
 ]
 
 
-# Copied from transformers.models.bart.modeling_bart._expand_mask
-def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int] = None):
+def _expand_mask(mask: torch.Tensor, dtype: torch.dtype):
     """
-    Expands attention_mask from `[bsz, seq_len]` to `[bsz, 1, tgt_seq_len, src_seq_len]`.
+    Expands the boolean attention_mask from `[bsz, seq_len]` to an additive `[bsz, 1, 1, seq_len]` mask, which is
+    broadcast over the heads and query positions of the attention scores instead of being materialized for each of them.
     """
     bsz, src_len = mask.size()
-    tgt_len = tgt_len if tgt_len is not None else src_len
-
-    expanded_mask = mask[:, None, None, :].expand(bsz, 1, tgt_len, src_len).to(dtype)
+    expanded_mask = torch.zeros((bsz, 1, 1, src_len), dtype=dtype, device=mask.device)
 
-    inverted_mask = 1.0 - expanded_mask
-
-    return inverted_mask.masked_fill(inverted_mask.to(torch.bool), torch.finfo(dtype).min)
+    return expanded_mask.masked_fill_(~mask[:, None, None, :], torch.finfo(dtype).min)
 
 
 class MCTCTConv1dSubsampler(nn.Module):
@@ -108,27 +100,35 @@ class MCTCTConv1dSubsampler(nn.Module):
 
         # NOTE: MCTCT by construction only uses one convolution kernel. I've made this flexible to allow for
         # multiple layers of convolutions, but not sure if this model definition should just restrict it
-        # to one layer. This becomes especially relevant when considering the padding like line 1 of forward().
+        # to one layer. Each convolution pads its own input by `kernel_size // 2`, which is also what
+        # `_get_feat_extract_output_lengths` assumes.
         self.conv_layers = nn.ModuleList(
             nn.Conv1d(
                 self.in_channels if i == 0 else self.mid_channels[i],
                 self.mid_channels[i] if i < self.num_layers - 1 else self.out_channels,
                 kernel_size=k,
                 stride=self.stride[i],
-                padding="valid",
+                padding=k // 2,
             )
             for i, k in enumerate(self.kernel_size)
         )
 
     def forward(self, input_features):
-        # NOTE: in reference to the NOTE in __init__, right now it just calculates padding as if
-        # there will be just one conv layer.
-        padding = sum([size // 2 for size in self.kernel_size])  # (7, 7) -> (3, 3)
-
-        input_features = torch.nn.functional.pad(input_features, (0, 0, padding, padding), "constant", 0)
-        hidden_states = input_features.transpose(1, 2).contiguous()  # -> Batch x Frame x Time
+        hidden_states = input_features.transpose(1, 2)  # -> Batch x Frame x Time
         for conv in self.conv_layers:
-            hidden_states = conv(hidden_states)
+            # the convolution runs as a 2D convolution over a singleton height dimension, as which the transposed
+            # Batch x Time x Frame features already are a channels last (NHWC) tensor, without copying them. This
+            # calls the functional op on the Conv1d parameters, so hooks registered on `conv` do not run, and relies
+            # on the layers being built with the default zero `padding_mode`
+            hidden_states = nn.functional.conv2d(
+                hidden_states.unsqueeze(2),
+                conv.weight.unsqueeze(2),
+                conv.bias,
+                stride=(1,) + conv.stride,
+                padding=(0,) + conv.padding,
+                dilation=(1,) + conv.dilation,
+                groups=conv.groups,
+            ).squeeze(2)
             hidden_states = nn.functional.glu(hidden_states, dim=self.glu_dim)
             hidden_states = self.dropout(hidden_states)
 
@@ -136,63 +136,6 @@ class MCTCTConv1dSubsampler(nn.Module):
         return hidden_states
 
 
-class MCTCTEmbeddings(nn.Module):
-    """Construct the embeddings from word, position and token_type embeddings."""
-
-    def __init__(self, config):
-        super().__init__()
-        self.word_embeddings = nn.Embedding(config.vocab_size, config.hidden_size, padding_idx=config.pad_token_id)
-        self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
-        self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
-
-        # self.LayerNorm is not snake-cased to stick with TensorFlow model variable name and be able to load
-        # any TensorFlow checkpoint file
-        # self.LayerNorm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
-        self.LayerNorm = MCTCTLayerNorm()
-        self.dropout = nn.Dropout(config.hidden_dropout_prob)
-
-        # position_ids (1, len position emb) is contiguous in memory and exported when serialized
-        self.register_buffer("position_ids", torch.arange(config.max_position_embeddings).expand((1, -1)))
-        if version.parse(torch.__version__) > version.parse("1.6.0"):
-            self.register_buffer(
-                "token_type_ids",
-                torch.zeros(self.position_ids.size(), dtype=torch.long, device=self.position_ids.device),
-                persistent=False,
-            )
-
-    def forward(
-        self, input_features=None, token_type_ids=None, position_ids=None, inputs_embeds=None, past_key_values_length=0
-    ):
-        input_shape = input_features.size() if input_features is not None else inputs_embeds.size()[:-1]
-
-        seq_length = input_shape[1]
-
-        if position_ids is None:
-            position_ids = self.position_ids[:, past_key_values_length : seq_length + past_key_values_length]
-
-        # Setting the token_type_ids to the registered buffer in constructor where it is all zeros, which usually occurs
-        # when its auto-generated, registered buffer helps users when tracing the model without passing token_type_ids, solves
-        # issue #5664
-        if token_type_ids is None:
-            if hasattr(self, "token_type_ids"):
-                buffered_token_type_ids = self.token_type_ids[:, :seq_length]
-                buffered_token_type_ids_expanded = buffered_token_type_ids.expand(input_shape[0], seq_length)
-                token_type_ids = buffered_token_type_ids_expanded
-            else:
-                token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=self.position_ids.device)
-
-        if inputs_embeds is None:
-            inputs_embeds = self.word_embeddings(input_features)
-
-        token_type_embeddings = self.token_type_embeddings(token_type_ids)
-
-        embeddings = inputs_embeds + token_type_embeddings
-
-        embeddings = self.LayerNorm(embeddings)
-        embeddings = self.dropout(embeddings)
-        return embeddings
-
-
 class MCTCTSelfAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -205,6 +148,7 @@ class MCTCTSelfAttention(nn.Module):
         self.num_attention_heads = config.num_attention_heads
         self.attention_head_size = config.attention_head_dim
         self.all_head_size = self.num_attention_heads * self.attention_head_size
+        self.scaling = self.attention_head_size**-0.5
 
         self.query = nn.Linear(config.hidden_size, self.all_head_size, bias=False)
         self.key = nn.Linear(config.hidden_size, self.all_head_size, bias=False)
@@ -222,35 +166,24 @@ class MCTCTSelfAttention(nn.Module):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def reshape_fortran(self, x, shape):
-        if len(x.shape) > 0:
-            x = x.permute(*reversed(range(len(x.shape))))
-        return x.reshape(*reversed(shape)).permute(*reversed(range(len(shape))))
-
     def relative_position_embedding_rotate(self, scores):
-        # NOTE: should re-evaluate whether this re-implementation was truly necessary
-        # or the reason why my complete re-haul worked was due to some other part
-        # of the code. Adding this and the reshape fortrain code seems very undesirable.
-        scores = scores.permute(0, 2, 3, 1)  # e.g. [10, 1839, 14, 4]
-
-        batch, hidden_state, seq_len, heads = scores.shape
-
-        # e.g. [10, 1853, 14, 4]
-        scores = torch.cat((scores, torch.zeros((batch, seq_len, seq_len, heads), device=scores.device)), dim=1)
-
-        # e.g. [10, 25942, 1, 4]
-        scores = self.reshape_fortran(scores, [batch, (hidden_state + seq_len) * seq_len, 1, heads])
-
-        # e.g. [10, 25928, 1, 4]
-        scores = scores[:, : (seq_len + hidden_state - 1) * seq_len]
+        # skews the scores of every query against all relative positions, so that afterwards `scores[..., i, j]`
+        # holds the score of query `i` against the relative distance `j - i`
+        batch, heads, seq_len, num_positions = scores.shape
+        halfpoint = num_positions // 2
 
-        # e.g. [10, 1852, 14, 4]
-        scores = self.reshape_fortran(scores, [batch, hidden_state + seq_len - 1, seq_len, heads])
+        # sequences longer than the relative position table attend to the out-of-range distances with a zero score,
+        # so the rows are first zero-padded until they hold all `seq_len` positions from the halfpoint on
+        extra_positions = max(halfpoint + seq_len - num_positions, 0)
+        num_positions += extra_positions
 
-        halfpoint = hidden_state // 2
-        scores = scores[:, halfpoint : halfpoint + seq_len].transpose(1, 2)  # e.g. [10, 14, 14, 4]
+        # padding every row by one more position and re-viewing the flattened rows with the (unpadded) row length
+        # offsets each row by one more position than the previous one
+        scores = nn.functional.pad(scores, (0, extra_positions + 1))
+        scores = scores.reshape(batch, heads, -1)[..., : seq_len * num_positions]
+        scores = scores.view(batch, heads, seq_len, num_positions)
 
-        return scores.permute(0, 3, 1, 2)
+        return scores[..., halfpoint : halfpoint + seq_len]
 
     def forward(
         self,
@@ -259,40 +192,57 @@ class MCTCTSelfAttention(nn.Module):
         head_mask=None,
         output_attentions=False,
     ):
-        mixed_query_layer = self.query(hidden_states)
-        mixed_query_layer = mixed_query_layer / math.sqrt(self.attention_head_size)
-
+        query_layer = self.transpose_for_scores(self.query(hidden_states))
         key_layer = self.transpose_for_scores(self.key(hidden_states))
         value_layer = self.transpose_for_scores(self.value(hidden_states))
 
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-
-        # relative key position embeddings
-        positional_embedding = self.distance_embedding.weight
-        relative_position_scores = torch.einsum("lh, bche -> bcle", positional_embedding, query_layer.transpose(2, 3))
+        # relative key position embeddings, the query is not pre-scaled so the 1 / sqrt(head_size) attention scaling
+        # is applied to the (much smaller) embedding table instead
+        positional_embedding = self.distance_embedding.weight * self.scaling
+        relative_position_scores = torch.matmul(query_layer, positional_embedding.t())
 
         relative_position_scores = self.relative_position_embedding_rotate(relative_position_scores)
-        attention_scores = attention_scores + relative_position_scores
 
         if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in MCTCTModel forward() function)
-            attention_scores = attention_scores + attention_mask
+            # Apply the attention mask (precomputed for all layers in MCTCTEncoder forward() function) as a broadcast
+            # `[bsz, 1, 1, seq_len]` tensor, in place since the relative position scores are a fresh tensor that no
+            # other op needs for its backward pass
+            relative_position_scores.add_(attention_mask)
+
+        if not output_attentions and head_mask is None and not is_torch_less_than_2_0:
+            # the relative position scores (and attention mask) are an additive bias of the attention scores, which
+            # lets the scaled query-key product, softmax, dropout and value product run as one fused kernel
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer,
+                key_layer,
+                value_layer,
+                attn_mask=relative_position_scores,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+        else:
+            batch_size, num_heads, seq_length, head_size = query_layer.shape
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.functional.softmax(attention_scores, dim=-1)
+            # Take the scaled dot product between "query" and "key" and accumulate it onto the relative position
+            # scores to get the raw attention scores.
+            attention_scores = torch.baddbmm(
+                relative_position_scores.reshape(batch_size * num_heads, seq_length, seq_length),
+                query_layer.reshape(batch_size * num_heads, seq_length, head_size),
+                key_layer.reshape(batch_size * num_heads, seq_length, head_size).transpose(1, 2),
+                alpha=self.scaling,
+            ).view(batch_size, num_heads, seq_length, seq_length)
 
-        # This is actually dropping out entire tokens to attend to, which might
-        # seem a bit unusual, but is taken from the original Transformer paper.
-        attention_probs = self.dropout(attention_probs)
+            # Normalize the attention scores to probabilities.
+            attention_probs = nn.functional.softmax(attention_scores, dim=-1)
 
-        # Mask heads if we want to
-        if head_mask is not None:
-            attention_probs = attention_probs * head_mask
+            # This is actually dropping out entire tokens to attend to, which might
+            # seem a bit unusual, but is taken from the original Transformer paper.
+            attention_probs = self.dropout(attention_probs)
+
+            # Mask heads if we want to
+            if head_mask is not None:
+                attention_probs = attention_probs * head_mask
 
-        context_layer = torch.matmul(attention_probs, value_layer)
+            context_layer = torch.matmul(attention_probs, value_layer)
 
         context_layer = context_layer.permute(0, 2, 1, 3).flatten(start_dim=-2)
 
@@ -308,7 +258,7 @@ class MCTCTLayerNorm(nn.Module):
         self.singleton_bias = nn.Parameter(torch.zeros(1))
 
     def forward(self, hidden_states):
-        return (hidden_states * self.singleton_weight) + self.singleton_bias
+        return torch.addcmul(self.singleton_bias, hidden_states, self.singleton_weight)
 
 
 class MCTCTSelfOutput(nn.Module):
@@ -424,9 +374,13 @@ class MCTCTLayer(nn.Module):
         attention_output = self_attention_outputs[0]
         outputs = self_attention_outputs[1:]  # add self attentions if we output attention weights
 
-        layer_output = apply_chunking_to_forward(
-            self.feed_forward_chunk, self.chunk_size_feed_forward, self.seq_len_dim, attention_output
-        )
+        if self.chunk_size_feed_forward > 0:
+            layer_output = apply_chunking_to_forward(
+                self.feed_forward_chunk, self.chunk_size_feed_forward, self.seq_len_dim, attention_output
+            )
+        else:
+            # no chunking, skip the signature inspection done by `apply_chunking_to_forward` on every call
+            layer_output = self.feed_forward_chunk(attention_output)
 
         outputs = (layer_output,) + outputs
 
@@ -447,7 +401,6 @@ class MCTCTPreTrainedModel(PreTrainedModel):
     config_class = MCTCTConfig
     base_model_prefix = "mctct"
     main_input_name = "input_features"
-    _keys_to_ignore_on_load_missing = ["position_ids"]
     supports_gradient_checkpointing = True
 
     def _init_weights(self, module):
@@ -494,17 +447,11 @@ class MCTCTPreTrainedModel(PreTrainedModel):
         if len(attention_mask.shape) > 2:
             attention_mask = attention_mask[:, :, -1]
 
-        # subsampled_lengths = attention_mask.sum(-1)
         subsampled_lengths = self._get_feat_extract_output_lengths(attention_mask.sum(-1))
-        bsz = attention_mask.size()[0]
-        attention_mask = torch.zeros(
-            (bsz, feature_vector_length), dtype=attention_mask.dtype, device=attention_mask.device
-        )
 
-        # these two operations makes sure that all values
-        # before the output lengths indices are attended to
-        attention_mask[(torch.arange(bsz, device=attention_mask.device), subsampled_lengths - 1)] = 1
-        attention_mask = attention_mask.flip([-1]).cumsum(-1).flip([-1]).long()
+        # all values before the output lengths indices are attended to
+        positions = torch.arange(feature_vector_length, device=attention_mask.device)
+        attention_mask = positions[None, :] < subsampled_lengths[:, None]
         return attention_mask
 
     def _set_gradient_checkpointing(self, module, value=False):
@@ -575,12 +522,6 @@ class MCTCTEncoder(MCTCTPreTrainedModel):
         output_hidden_states=False,
         return_dict=True,
     ):
-        output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
-        output_hidden_states = (
-            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
-        )
-        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-
         input_features = self.layer_norm(input_features)
 
         inputs_embeds = self.conv(input_features)
@@ -593,11 +534,12 @@ class MCTCTEncoder(MCTCTPreTrainedModel):
 
         # expand attention_mask
         if attention_mask is not None:
-            # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
+            # [bsz, seq_len] -> [bsz, 1, 1, seq_len], built once and shared by all layers, which only ever
+            # broadcast-add it to their attention scores and must never expand, copy or cast it per layer
             attention_mask = _expand_mask(attention_mask, inputs_embeds.dtype)
 
-        encoder_states = () if output_hidden_states else None
-        all_attentions = () if output_attentions else None
+        encoder_states = [] if output_hidden_states else None
+        all_attentions = [] if output_attentions else None
 
         # check if head_mask has a correct number of layers specified if desired
         if head_mask is not None:
@@ -607,35 +549,41 @@ class MCTCTEncoder(MCTCTPreTrainedModel):
                     f"but it is for {head_mask.size()[0]}."
                 )
 
+        # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description), drawn for all layers at once; in eval
+        # mode or with layerdrop == 0 every layer runs, so the encoder has no data-dependent control flow
+        if self.training and self.config.layerdrop > 0:
+            skip_layers = (torch.rand(len(self.layers)) < self.config.layerdrop).tolist()
+        else:
+            skip_layers = [False] * len(self.layers)
+
+        if self.gradient_checkpointing and self.training:
+            # the non-reentrant implementation does not need the layer inputs to require grad and saves no extra
+            # autograd graph per checkpointed layer
+            checkpoint_kwargs = {} if is_torch_less_than_1_11 else {"use_reentrant": False}
+
         deepspeed_zero3_is_enabled = is_deepspeed_zero3_enabled()
         for idx, encoder_layer in enumerate(self.layers):
             if output_hidden_states:
-                encoder_states = encoder_states + (hidden_states,)
-
-            # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
-            dropout_probability = random.uniform(0, 1)
+                encoder_states.append(hidden_states)
 
-            skip_the_layer = True if self.training and (dropout_probability < self.config.layerdrop) else False
+            skip_the_layer = skip_layers[idx]
             if not skip_the_layer or deepspeed_zero3_is_enabled:
                 # under deepspeed zero3 all gpus must run in sync
                 if self.gradient_checkpointing and self.training:
-
-                    def create_custom_forward(module):
-                        def custom_forward(*inputs):
-                            return module(*inputs, output_attentions)
-
-                        return custom_forward
-
+                    # the layer takes `output_attentions` positionally, so it can be checkpointed without a wrapper
                     layer_outputs = torch.utils.checkpoint.checkpoint(
-                        create_custom_forward(encoder_layer),
+                        encoder_layer,
                         hidden_states,
                         attention_mask,
                         (head_mask[idx] if head_mask is not None else None),
+                        output_attentions,
+                        **checkpoint_kwargs,
                     )
                 else:
                     layer_outputs = encoder_layer(
                         hidden_states=hidden_states,
                         attention_mask=attention_mask,
+                        head_mask=(head_mask[idx] if head_mask is not None else None),
                         output_attentions=output_attentions,
                     )
 
@@ -645,10 +593,13 @@ class MCTCTEncoder(MCTCTPreTrainedModel):
                 layer_outputs = (None, None)
 
             if output_attentions:
-                all_attentions = all_attentions + (layer_outputs[1],)
+                all_attentions.append(layer_outputs[1])
 
         if output_hidden_states:
-            encoder_states = encoder_states + (hidden_states,)
+            encoder_states.append(hidden_states)
+            encoder_states = tuple(encoder_states)
+        if output_attentions:
+            all_attentions = tuple(all_attentions)
 
         if not return_dict:
             return tuple(v for v in [hidden_states, encoder_states, all_attentions] if v is not None)
@@ -698,6 +649,11 @@ class MCTCTModel(MCTCTPreTrainedModel):
         if input_features is None:
             raise ValueError("You have to specify input_features.")
 
+        # [num_hidden_layers, num_heads] -> [num_hidden_layers, 1, num_heads, 1, 1], broadcastable over the attention
+        # probabilities of each layer
+        if head_mask is not None:
+            head_mask = self.get_head_mask(head_mask, self.config.num_hidden_layers)
+
         encoder_outputs = self.encoder(
             input_features,
             attention_mask=attention_mask,
@@ -789,13 +745,12 @@ class MCTCTForCTC(MCTCTPreTrainedModel):
             if labels.max() >= self.config.vocab_size:
                 raise ValueError(f"Label values must be <= vocab_size: {self.config.vocab_size}")
 
-            # retrieve loss input_lengths from attention_mask
-            attention_mask = (
-                attention_mask
-                if attention_mask is not None
-                else torch.ones(input_features.shape[:-1], dtype=torch.long)
-            )
-            input_lengths = self._get_feat_extract_output_lengths(attention_mask.sum(-1)).to(torch.long)
+            # retrieve loss input_lengths from attention_mask, without a mask every sequence spans all the logits;
+            # ctc_loss needs the lengths on the host, so build those directly on the CPU
+            if attention_mask is not None:
+                input_lengths = self._get_feat_extract_output_lengths(attention_mask.sum(-1)).to(torch.long)
+            else:
+                input_lengths = torch.full((logits.shape[0],), logits.shape[1], dtype=torch.long)
             # assuming that padded tokens are filled with -100
             # when not being attended to
             labels_mask = labels >= 0
@@ -16,12 +16,15 @@
 
 import inspect
 import math
+import os
+import tempfile
 import unittest
 
 from datasets import load_dataset
 
 from transformers import MCTCTConfig, is_torch_available
 from transformers.testing_utils import require_soundfile, require_torch, slow, torch_device
+from transformers.utils import WEIGHTS_INDEX_NAME
 
 from ...test_configuration_common import ConfigTester
 from ...test_modeling_common import ModelTesterMixin, _config_zero_init, floats_tensor, ids_tensor
@@ -31,6 +34,7 @@ if is_torch_available():
     import torch
 
     from transformers import MCTCTForCTC, MCTCTModel, MCTCTProcessor
+    from transformers.pytorch_utils import is_torch_less_than_2_0
 
 
 class MCTCTModelTester:
@@ -264,7 +268,6 @@ class MCTCTModelTester:
 class MCTCTModelTest(ModelTesterMixin, unittest.TestCase):
     all_model_classes = (MCTCTForCTC, MCTCTModel) if is_torch_available() else ()
     test_pruning = False
-    test_headmasking = False
     test_torchscript = False
 
     def setUp(self):
@@ -278,6 +281,47 @@ class MCTCTModelTest(ModelTesterMixin, unittest.TestCase):
         config_and_inputs = self.model_tester.prepare_config_and_inputs()
         self.model_tester.create_and_check_model(*config_and_inputs)
 
+    def test_model_longer_than_max_position_embeddings(self):
+        config, input_features, attention_mask = self.model_tester.prepare_config_and_inputs()
+        # the subsampled sequence is longer than the relative position table
+        config.max_position_embeddings = self.model_tester.output_seq_length // 2
+        self.model_tester.create_and_check_model(config, input_features, attention_mask)
+
+    @unittest.skipIf(is_torch_available() and is_torch_less_than_2_0, "scaled_dot_product_attention needs torch>=2.0")
+    def test_sdpa_matches_eager_attention(self):
+        config, input_features, attention_mask = self.model_tester.prepare_config_and_inputs()
+        attention_mask[1, self.model_tester.seq_length // 2 :] = 0
+        model = MCTCTModel(config).to(torch_device).eval()
+
+        # attention weights are only computed by the eager attention, otherwise scaled_dot_product_attention is used
+        with torch.no_grad():
+            sdpa_output = model(input_features, attention_mask=attention_mask).last_hidden_state
+            eager_output = model(
+                input_features, attention_mask=attention_mask, output_attentions=True
+            ).last_hidden_state
+        self.assertTrue(torch.allclose(sdpa_output, eager_output, atol=1e-4))
+
+    def test_load_sharded_checkpoint(self):
+        config, input_features, attention_mask = self.model_tester.prepare_config_and_inputs()
+        model = MCTCTModel(config).to(torch_device).eval()
+        # the query, key and value weights are stored separately, as in the checkpoints on the Hub
+        self.assertIn("encoder.layers.0.attention.self.query.weight", model.state_dict())
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            # small enough for the query, key and value weights of a layer to land in different shards
+            model.save_pretrained(tmpdirname, max_shard_size="100KB")
+            self.assertTrue(os.path.isfile(os.path.join(tmpdirname, WEIGHTS_INDEX_NAME)))
+            new_model, loading_info = MCTCTModel.from_pretrained(tmpdirname, output_loading_info=True)
+
+        self.assertEqual(loading_info["missing_keys"], [])
+        self.assertEqual(loading_info["unexpected_keys"], [])
+
+        new_model.to(torch_device).eval()
+        with torch.no_grad():
+            output = model(input_features, attention_mask=attention_mask).last_hidden_state
+            new_output = new_model(input_features, attention_mask=attention_mask).last_hidden_state
+        self.assertTrue(torch.allclose(output, new_output, atol=1e-5))
+
     def test_ctc_loss_inference(self):
         config_and_inputs = self.model_tester.prepare_config_and_inputs()
         self.model_tester.check_ctc_loss(*config_and_inputs)
@@ -419,7 +463,6 @@ class MCTCTModelTest(ModelTesterMixin, unittest.TestCase):
 class MCTCTRobustModelTest(ModelTesterMixin, unittest.TestCase):
     all_model_classes = (MCTCTForCTC, MCTCTModel) if is_torch_available() else ()
     test_pruning = False
-    test_headmasking = False
     test_torchscript = False
 
     def setUp(self):